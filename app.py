@@ -1,15 +1,22 @@
 # app.py
 import streamlit as st
 import pandas as pd
+import csv
+import datetime
+import hashlib
+import io
 import json
 import os
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from dotenv import load_dotenv
 from extractor import (
     fetch_html,
-    snapshot_to_db,
+    connect_db,
+    snapshot_to_db_many,
     extract_from_html,
     llm_infer_selectors,
+    RECENT_SNAPSHOTS_SQL,
     GEMINI_API_KEY
 )
 
@@ -18,6 +25,121 @@ load_dotenv()
 
 DB_PATH = "snapshots.db"
 SNAPSHOT_DIR = "snapshots"
+MAX_WORKERS = 8
+
+
+@st.cache_resource
+def get_conn():
+    """Single SQLite connection shared across reruns and sessions."""
+    return connect_db(DB_PATH)
+
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _cached_fetch(url):
+    """Returns (final_url, html, fetched_at); fetched_at is when the network fetch actually ran."""
+    final_url, html = fetch_html(url)
+    return final_url, html, datetime.datetime.utcnow()
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _cached_extract(html, mapping_tuple):
+    return extract_from_html(html, dict(mapping_tuple))
+
+
+def _flatten(record, prefix=""):
+    """Flatten nested dicts into dotted keys, like pd.json_normalize."""
+    flat = {}
+    for key, value in record.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{name}."))
+        else:
+            flat[name] = value
+    return flat
+
+
+def _flat_keys(rows):
+    """Union of column names in first-seen order."""
+    return list(dict.fromkeys(key for row in rows for key in row))
+
+
+def to_csv_bytes(rows):
+    flat_rows = [_flatten(r) for r in rows]
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=_flat_keys(flat_rows), lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(flat_rows)
+    return buf.getvalue().encode("utf-8")
+
+
+def _input_key(item):
+    """Identity of an input's content: the URL, or a BLAKE2b digest of the HTML bytes."""
+    typ, payload = item
+    if typ == "url":
+        return ("url", payload)
+    return ("html", hashlib.blake2b(payload[1], digest_size=16).digest())
+
+
+def _reuse_outcome(outcome, typ, payload):
+    """Copy a duplicate input's outcome under this input's own name."""
+    reused = dict(outcome, fetched=False, fetched_at=None)
+    if typ != "url":
+        reused["src"] = payload[0]
+    if outcome["extracted"] is not None:
+        reused["extracted"] = dict(outcome["extracted"], _source=reused["src"])
+    return reused
+
+
+def process_input(item, base_mapping, use_llm, run_started):
+    """
+    Fetch/load one input, optionally infer selectors, and extract it.
+    Runs on a worker thread, so it must not touch Streamlit; the main
+    thread renders the returned outcome.
+    `fetched` is True only when the page came off the network during this
+    run (not from the fetch cache), so only fresh pages become snapshots.
+    """
+    typ, payload = item
+    outcome = {
+        "src": "", "html": "", "fetched": False, "fetched_at": None,
+        "inferred": None, "extracted": None, "error": None
+    }
+
+    # --------------- Fetch or Load HTML ---------------
+    if typ == "url":
+        try:
+            final_url, html, fetched_at = _cached_fetch(payload)
+        except Exception as e:
+            outcome["error"] = f"❌ Failed to fetch {payload}: {e}"
+            return outcome
+        outcome.update(
+            src=final_url, html=html,
+            fetched=fetched_at >= run_started, fetched_at=fetched_at.isoformat()
+        )
+    else:
+        name, html = payload
+        outcome.update(src=name, html=html)
+    src = outcome["src"]
+
+    # --------------- Optional LLM Inference ---------------
+    mapping = base_mapping.copy()
+    if use_llm:
+        inferred = llm_infer_selectors(html, GEMINI_API_KEY)
+        outcome["inferred"] = inferred
+        for key in ["title", "price", "availability"]:
+            if inferred.get(key) and not mapping.get(key):
+                mapping[key] = inferred[key]
+
+    # --------------- Extract Data ---------------
+    try:
+        extracted = _cached_extract(html, tuple(sorted(mapping.items())))
+        # Stamp after the cache lookup so hits don't report the first extraction's time
+        extracted["extraction_timestamp"] = datetime.datetime.utcnow().isoformat() + "Z"
+        extracted["_source"] = src
+        outcome["extracted"] = extracted
+    except Exception as e:
+        outcome["error"] = f"❌ Extraction error for {src}: {e}"
+    return outcome
+
 
 # ------------------- Streamlit Page Config -------------------
 st.set_page_config(
@@ -112,71 +234,79 @@ if run:
     # Collect uploaded files
     if uploaded_files:
         for file in uploaded_files:
-            html = file.read().decode("utf-8", errors="replace")
-            inputs.append(("upload", (file.name, html)))
+            # Raw bytes go straight to the parser; no decode round-trip
+            inputs.append(("upload", (file.name, file.read())))
 
     # Collect chosen snapshot
     if chosen_snapshot and chosen_snapshot != "(none)":
         path = os.path.join(SNAPSHOT_DIR, chosen_snapshot)
-        with open(path, "r", encoding="utf-8") as f:
-            html = f.read()
-        inputs.append(("snapshot", (chosen_snapshot, html)))
+        with open(path, "rb") as f:
+            inputs.append(("snapshot", (chosen_snapshot, f.read())))
 
     if not inputs:
         st.warning("Please provide at least one URL, upload, or snapshot.")
     else:
         results = []
-        for typ, payload in inputs:
-            html = ""
-            src = ""
-
-            # --------------- Fetch or Load HTML ---------------
-            if typ == "url":
-                url = payload
-                if not use_live:
-                    st.warning(f"Skipping live fetch (disabled): {url}")
-                    continue
-                try:
-                    final_url, html = fetch_html(url)
-                    src = final_url
-                    if db_save:
-                        snapshot_to_db(DB_PATH, final_url, html)
-                    if show_raw_html:
-                        with st.expander(f"Raw HTML for {final_url}"):
-                            st.code(html[:3000])
-                except Exception as e:
-                    st.error(f"❌ Failed to fetch {url}: {e}")
-                    continue
-            elif typ in ("upload", "snapshot"):
-                name, html = payload
-                src = name
-
-            # --------------- Optional LLM Inference ---------------
-            mapping = mapping_input.copy()
-            if use_llm_inference and GEMINI_API_KEY:
-                with st.spinner(f"🤖 Using Gemini AI to infer selectors for {src}..."):
-                    inferred = llm_infer_selectors(html, GEMINI_API_KEY)
-                    if inferred:
-                        for key in ["title", "price", "availability"]:
-                            if inferred.get(key) and not mapping.get(key):
-                                mapping[key] = inferred[key]
-                        st.success(f"✅ Gemini suggested: {inferred}")
-                    else:
-                        st.warning("⚠️ Gemini could not infer selectors. Using heuristics.")
-
-            # --------------- Extract Data ---------------
+        snapshot_rows = []
+
+        if not use_live:
+            for typ, payload in inputs:
+                if typ == "url":
+                    st.warning(f"Skipping live fetch (disabled): {payload}")
+            inputs = [item for item in inputs if item[0] != "url"]
+
+        # --------------- Process Inputs in Parallel ---------------
+        use_llm = bool(use_llm_inference and GEMINI_API_KEY)
+        worker = partial(
+            process_input, base_mapping=mapping_input, use_llm=use_llm,
+            run_started=datetime.datetime.utcnow()
+        )
+        # Identical URLs / HTML bodies are processed once and the outcome reused
+        keys = [_input_key(item) for item in inputs]
+        unique = {}
+        for key, item in zip(keys, inputs):
+            unique.setdefault(key, item)
+        with st.spinner(f"Processing {len(unique)} unique input(s)..."):
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+                by_key = dict(zip(unique, pool.map(worker, unique.values())))
+
+        outcomes = []
+        for key, item in zip(keys, inputs):
+            if unique[key] is item:
+                outcomes.append(by_key[key])
+            else:
+                outcomes.append(_reuse_outcome(by_key[key], *item))
+
+        for outcome in outcomes:
+            src = outcome["src"]
+            if outcome["fetched"] and db_save:
+                snapshot_rows.append((src, outcome["html"], outcome["fetched_at"]))
+            if outcome["fetched_at"] and show_raw_html:
+                with st.expander(f"Raw HTML for {src}"):
+                    st.code(outcome["html"][:3000])
+
+            if outcome["inferred"]:
+                st.success(f"✅ Gemini suggested for {src}: {outcome['inferred']}")
+            elif use_llm and src:
+                st.warning(f"⚠️ Gemini could not infer selectors for {src}. Using heuristics.")
+
+            if outcome["error"]:
+                st.error(outcome["error"])
+            else:
+                results.append(outcome["extracted"])
+
+        # --------------- Save Snapshots (single transaction) ---------------
+        if snapshot_rows:
             try:
-                extracted = extract_from_html(html, mapping)
-                extracted["_source"] = src
-                results.append(extracted)
+                snapshot_to_db_many(get_conn(), snapshot_rows)
             except Exception as e:
-                st.error(f"❌ Extraction error for {src}: {e}")
+                st.error(f"❌ Failed to save snapshots: {e}")
 
         # --------------- Display Results ---------------
         if results:
-            df = pd.json_normalize(results)
             st.success(f"✅ Extracted {len(results)} records successfully.")
-            st.dataframe(df)
+            with st.expander("Table view"):
+                st.dataframe(pd.DataFrame([_flatten(r) for r in results]))
 
             # Download buttons
             col1, col2 = st.columns(2)
@@ -188,7 +318,7 @@ if run:
             )
             col2.download_button(
                 label="📊 Download CSV",
-                data=df.to_csv(index=False).encode("utf-8"),
+                data=to_csv_bytes(results),
                 file_name="extracted.csv",
                 mime="text/csv"
             )
@@ -204,25 +334,8 @@ with st.sidebar:
     st.markdown("---")
     if st.button("📜 Show Last 20 Snapshots (SQLite)"):
         try:
-            conn = sqlite3.connect(DB_PATH)
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS snapshots (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    url TEXT,
-                    domain TEXT,
-                    fetched_at TEXT,
-                    html TEXT
-                )
-                """
-            )
-            conn.commit()
-            df_snap = pd.read_sql_query(
-                "SELECT id, url, domain, fetched_at FROM snapshots ORDER BY id DESC LIMIT 20",
-                conn
-            )
+            df_snap = pd.read_sql_query(RECENT_SNAPSHOTS_SQL, get_conn(), params=(20,))
             st.dataframe(df_snap)
-            conn.close()
         except Exception as e:
             st.error(f"Error loading snapshots: {e}")
 
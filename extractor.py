@@ -1,12 +1,18 @@
 # extractor.py
 import re
 import json
+import functools
+import hashlib
 import sqlite3
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
+from collections import OrderedDict
 from urllib.parse import urlparse
-from typing import Dict, Optional, Tuple, Any
+from typing import Dict, Iterable, Optional, Tuple, Union, Any
 from dotenv import load_dotenv
 import os
 
@@ -15,108 +21,177 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 # ---------- Regex patterns ----------
-CURRENCY_RE = re.compile(r'(\$|€|£|\u20B9)\s?[\d{1,3},]*\d+(\.\d+)?')
-NUMBER_RE = re.compile(r'[\d{1,3},]*\d+(\.\d+)?')
+CURRENCY_RE = re.compile(r'([$€£\u20B9])\s?(\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?)')
+NUMBER_RE = re.compile(r'\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?')
+
+AVAIL_RE = re.compile(r'in stock|out of stock|available|pre-?order', re.I)
+
+SCRIPT_STYLE_RE = re.compile(r'<(script|style)[^>]*>.*?</\1>', re.S | re.I)
+
+PRICE_KEYWORDS = ("price", "amount", "cost", "sale", "our-price")
+# Case-insensitive substring match on class/id, evaluated by lexbor in C
+PRICE_CLASS_SELECTOR = ", ".join(f'[class*="{k}" i]' for k in PRICE_KEYWORDS)
+PRICE_ID_SELECTOR = ", ".join(f'[id*="{k}" i]' for k in PRICE_KEYWORDS)
 
 # ---------- Fetch HTML ----------
+# One pooled session shared by all worker threads so TCP/TLS connections are reused.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+
+
 def fetch_html(url: str, timeout=10, headers=None) -> Tuple[str, str]:
     """
     Fetch a web page's HTML content.
     Returns (final_url, html).
     """
     headers = headers or {"User-Agent": "SafeExtractorBot/1.0 (+https://example.com)"}
-    r = requests.get(url, timeout=timeout, headers=headers)
+    r = _SESSION.get(url, timeout=timeout, headers=headers)
     r.raise_for_status()
     return r.url, r.text
 
 # ---------- Snapshot Storage ----------
-def snapshot_to_db(db_path: str, url: str, html: str):
+SNAPSHOT_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA busy_timeout=5000;
+"""
+
+_DB_WRITE_LOCK = threading.Lock()
+
+SNAPSHOTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT,
+        domain TEXT,
+        fetched_at TEXT,
+        html TEXT
+    );
+    CREATE INDEX IF NOT EXISTS ix_snapshots_domain ON snapshots(domain);
+    CREATE INDEX IF NOT EXISTS ix_snapshots_fetched_at ON snapshots(fetched_at);
+"""
+
+# Constant SQL text so sqlite3's per-connection statement cache reuses the plan
+RECENT_SNAPSHOTS_SQL = "SELECT id, url, domain, fetched_at FROM snapshots ORDER BY id DESC LIMIT ?"
+
+
+def connect_db(db_path: str) -> sqlite3.Connection:
+    """
+    Open a long-lived SQLite connection with tuning PRAGMAs and the schema applied.
+    Safe to share across threads; statements are issued in autocommit mode.
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    conn.executescript(SNAPSHOT_PRAGMAS + SNAPSHOTS_SCHEMA)
+    return conn
+
+
+def snapshot_to_db_many(conn: sqlite3.Connection, rows: Iterable[Tuple[str, str, Optional[str]]]):
+    """
+    Store many (url, html, fetched_at) snapshots using a single transaction on a shared connection.
+    fetched_at is an ISO timestamp of the network fetch; None means now.
+    """
+    with _DB_WRITE_LOCK:
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO snapshots (url, domain, fetched_at, html) VALUES (?, ?, ?, ?)",
+                (
+                    (url, urlparse(url).netloc, fetched_at or datetime.datetime.utcnow().isoformat(), html)
+                    for url, html, fetched_at in rows
+                )
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def snapshot_to_db(conn: sqlite3.Connection, url: str, html: str, fetched_at: Optional[str] = None):
     """
     Store HTML snapshot in SQLite for reproducibility.
     """
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS snapshots (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            url TEXT,
-            domain TEXT,
-            fetched_at TEXT,
-            html TEXT
-        )
-    """)
-    domain = urlparse(url).netloc
-    cur.execute(
-        "INSERT INTO snapshots (url, domain, fetched_at, html) VALUES (?, ?, ?, ?)",
-        (url, domain, datetime.datetime.utcnow().isoformat(), html)
-    )
-    conn.commit()
-    conn.close()
+    snapshot_to_db_many(conn, [(url, html, fetched_at)])
+
+# ---------- Parse HTML ----------
+def parse_html(html: Union[str, bytes]) -> LexborHTMLParser:
+    """
+    Parse HTML with selectolax (lexbor). Bytes are parsed directly as UTF-8.
+    Falls back to BeautifulSoup to repair input lexbor rejects.
+    """
+    try:
+        return LexborHTMLParser(html)
+    except Exception:
+        from bs4 import BeautifulSoup
+        return LexborHTMLParser(str(BeautifulSoup(html, "lxml")))
+
+
+def node_text(node) -> str:
+    """Equivalent of BeautifulSoup's get_text(" ", strip=True)."""
+    return node.text(separator=" ", strip=True, skip_empty=True)
 
 # ---------- Heuristic Inference ----------
-def infer_title(soup: BeautifulSoup) -> Optional[str]:
-    for tag in [
-        soup.find("meta", property="og:title"),
-        soup.find("meta", attrs={"name": "twitter:title"})
-    ]:
-        if tag and tag.get("content"):
-            return tag["content"].strip()
-
-    if soup.title and soup.title.text.strip():
-        return soup.title.text.strip()
-
-    for tag_name in ["h1", "h2", "h3"]:
-        tag = soup.find(tag_name)
-        if tag and tag.text.strip():
-            return tag.text.strip()
+def infer_title(tree: LexborHTMLParser) -> Optional[str]:
+    for selector in ['meta[property="og:title"]', 'meta[name="twitter:title"]']:
+        tag = tree.css_first(selector)
+        content = tag.attributes.get("content") if tag else None
+        if content and content.strip():
+            return content.strip()
+
+    for tag_name in ["title", "h1", "h2", "h3"]:
+        tag = tree.css_first(tag_name)
+        text = tag.text().strip() if tag else ""
+        if text:
+            return text
     return None
 
 
-def infer_price(soup: BeautifulSoup) -> Optional[str]:
-    def has_price_keyword(s): 
-        return any(k in s.lower() for k in ["price", "amount", "cost", "sale", "our-price"])
+def _scan_attr(tree: LexborHTMLParser, selector: str) -> Optional[str]:
+    """First currency amount inside an element matching `selector`."""
+    for tag in tree.css(selector):
+        m = CURRENCY_RE.search(node_text(tag))
+        if m:
+            return m.group(0)
+    return None
 
-    for tag in soup.find_all(True, attrs={"class": True}):
-        cls = " ".join(tag.get("class"))
-        if has_price_keyword(cls):
-            text = tag.get_text(" ", strip=True)
-            if CURRENCY_RE.search(text):
-                return CURRENCY_RE.search(text).group(0)
 
-    for tag in soup.find_all(True, attrs={"id": True}):
-        ident = tag.get("id")
-        if has_price_keyword(ident):
-            text = tag.get_text(" ", strip=True)
-            if CURRENCY_RE.search(text):
-                return CURRENCY_RE.search(text).group(0)
+def _scan_text(tree: LexborHTMLParser) -> Optional[str]:
+    """First currency amount in any text node, stopping at the first match."""
+    if tree.root:
+        for node in tree.root.traverse(include_text=True):
+            if node.tag == "-text":
+                m = CURRENCY_RE.search(node.text_content or "")
+                if m:
+                    return m.group(0)
+    return None
 
-    # fallback
-    text = soup.get_text(" ", strip=True)
-    m = CURRENCY_RE.search(text)
-    if m:
-        return m.group(0)
 
-    return None
+def infer_price(tree: LexborHTMLParser, text_fallback: bool = True) -> Optional[str]:
+    price = _scan_attr(tree, PRICE_CLASS_SELECTOR) or _scan_attr(tree, PRICE_ID_SELECTOR)
+    if price or not text_fallback:
+        return price
+    return _scan_text(tree)
 
 
-def infer_availability(soup: BeautifulSoup) -> Optional[str]:
-    text = soup.get_text(" ", strip=True).lower()
-    for phrase in ["in stock", "out of stock", "available", "pre-order", "preorder"]:
-        if phrase in text:
-            idx = text.find(phrase)
-            return text[max(0, idx - 30): idx + 50].strip()
+def infer_availability(tree: LexborHTMLParser) -> Optional[str]:
+    text = node_text(tree.root) if tree.root else ""
+    m = AVAIL_RE.search(text)
+    if m:
+        return text[max(0, m.start() - 30): m.start() + 50].lower().strip()
     return None
 
 # ---------- Apply CSS Selectors ----------
-def apply_selectors(soup: BeautifulSoup, mapping: Dict[str, str]) -> Dict[str, Optional[str]]:
+def apply_selectors(tree: LexborHTMLParser, mapping: Dict[str, str]) -> Dict[str, Optional[str]]:
     results = {}
     for field, selector in mapping.items():
+        selector = selector.strip() if selector else None
         if not selector:
             results[field] = None
             continue
         try:
-            tag = soup.select_one(selector)
-            results[field] = tag.get_text(" ", strip=True) if tag else None
+            tag = tree.css_first(selector)
+            results[field] = node_text(tag) if tag else None
         except Exception:
             results[field] = None
     return results
@@ -128,13 +203,16 @@ def normalize_fields(raw: Dict[str, Optional[str]]) -> Dict[str, Any]:
     amount = None
     if price_raw:
         m = CURRENCY_RE.search(price_raw)
+        num = m.group(2) if m else None
         if m:
             currency = m.group(1)
-        num_m = NUMBER_RE.search(price_raw)
-        if num_m:
+        else:
+            num_m = NUMBER_RE.search(price_raw)
+            num = num_m.group(0) if num_m else None
+        if num:
             try:
-                amount = float(num_m.group(0).replace(",", ""))
-            except:
+                amount = float(num.replace(",", ""))
+            except ValueError:
                 pass
     return {
         "title": raw.get("title"),
@@ -148,102 +226,216 @@ def normalize_fields(raw: Dict[str, Optional[str]]) -> Dict[str, Any]:
     }
 
 # ---------- Main Extractor ----------
-def extract_from_html(html: str, mapping: Dict[str, str] = {}) -> Dict[str, Any]:
-    """
-    mapping: {"title": "h1.title", "price": ".price", "availability": "#stock"}
-    If missing, uses heuristic inference.
-    """
-    soup = BeautifulSoup(html, "lxml")
-    selected = apply_selectors(soup, mapping)
+def _extract_fields(html: Union[str, bytes], mapping: Dict[str, str],
+                    text_fallback: bool = True) -> Dict[str, Optional[str]]:
+    tree = parse_html(html)
+    selected = apply_selectors(tree, mapping)
 
     # fallback to heuristics
     if not selected.get("title"):
-        selected["title"] = infer_title(soup)
+        selected["title"] = infer_title(tree)
     if not selected.get("price"):
-        selected["price"] = infer_price(soup)
+        selected["price"] = infer_price(tree, text_fallback)
     if not selected.get("availability"):
-        selected["availability"] = infer_availability(soup)
+        selected["availability"] = infer_availability(tree)
+    return selected
 
-    return normalize_fields(selected)
+
+def extract_from_html(html: Union[str, bytes], mapping: Dict[str, str] = {}, max_bytes: int = 0) -> Dict[str, Any]:
+    """
+    mapping: {"title": "h1.title", "price": ".price", "availability": "#stock"}
+    If missing, uses heuristic inference.
+    max_bytes: opt-in prefix parse for heuristic-only calls (characters for str
+    input). The prefix result is kept only if it yields a title, availability and
+    a price from a class/id match; otherwise the full page is parsed as well, so
+    pages missing a field cost two parses. 0 (default) always parses the full page.
+    """
+    if max_bytes and not any(mapping.values()) and len(html) > max_bytes:
+        # A text-node price in the prefix may be a banner ("free shipping over $50"),
+        # so only a class/id price counts here
+        selected = _extract_fields(html[:max_bytes], mapping, text_fallback=False)
+        if all(selected.get(f) for f in ("title", "price", "availability")):
+            return normalize_fields(selected)
+    return normalize_fields(_extract_fields(html, mapping))
 
 # ---------- Gemini-based Selector Inference (NEW SDK) ----------
-def llm_infer_selectors(html: str, api_key: str):
+LLM_HTML_CHARS = 4000
+LLM_CACHE_SIZE = 256
+
+# Newest first; the first entry is tried alone, the rest race as fallbacks.
+LLM_MODELS = [
+    "gemini-2.5-flash",
+    "gemini-2.0-flash",
+    "gemini-1.5-flash",
+    "gemini-1.5-pro"
+]
+
+# (sha256 of trimmed HTML, API key fingerprint) -> JSON text of inferred selectors.
+# Lives at module level so it survives Streamlit reruns; failures are not cached.
+_llm_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_llm_cache_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=4)
+def _genai_client(api_key: str):
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+
+def trim_html_for_llm(html: str) -> str:
+    """Drop <script>/<style> blocks, then keep the first LLM_HTML_CHARS characters."""
+    return SCRIPT_STYLE_RE.sub("", html)[:LLM_HTML_CHARS]
+
+
+def llm_infer_selectors(html: Union[str, bytes], api_key: str):
     """
     Use Google Gemini to infer CSS selectors for product title, price, and availability.
     Returns a dict like {"title": "h1.product-title", "price": "span.price", "availability": "#stock"}
+    Results are memoised by a hash of the HTML sent to the model.
     """
     if not api_key:
         print("Gemini API key not found in environment (.env).")
         return {}
 
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", errors="replace")
+    html_prefix = trim_html_for_llm(html)
+    key = (
+        hashlib.sha256(html_prefix.encode("utf-8", errors="replace")).hexdigest(),
+        hashlib.sha256(api_key.encode()).hexdigest()[:16],
+    )
+    with _llm_cache_lock:
+        cached = _llm_cache.get(key)
+        if cached is not None:
+            _llm_cache.move_to_end(key)
+            return json.loads(cached)
+
+    parsed = _llm_request_selectors(html_prefix, api_key)
+    if parsed:
+        with _llm_cache_lock:
+            _llm_cache[key] = json.dumps(parsed)
+            while len(_llm_cache) > LLM_CACHE_SIZE:
+                _llm_cache.popitem(last=False)
+    return parsed
+
+
+def _llm_request_selectors(html_prefix: str, api_key: str):
     try:
-        from google import genai
         from google.genai import types
+        client = _genai_client(api_key)
     except ImportError:
         print("Error: google-genai package not installed. Run: pip install google-genai")
         return {}
+    except Exception as exc:
+        print(f"[Gemini inference error] Could not create client -> {exc}")
+        return {}
 
     prompt = (
         "You are an expert HTML analyst. Given the following HTML, identify the correct CSS selectors "
         "for three elements: product title, product price, and availability. "
         "Respond ONLY as a JSON object with keys: title, price, availability.\n\n"
         "Example output: {\"title\": \"h1.product-title\", \"price\": \"span.price\", \"availability\": \"#stock\"}\n\n"
-        f"HTML:\n{html[:6000]}"
+        f"HTML:\n{html_prefix}"
     )
 
-    # List of models to try (newest first)
-    models_to_try = [
-        "gemini-2.5-flash",
-        "gemini-2.0-flash",
-        "gemini-1.5-flash",
-        "gemini-1.5-pro"
-    ]
-
     errors = {}
-    
-    for model_name in models_to_try:
-        try:
-            # Create client with API key
-            client = genai.Client(api_key=api_key)
-            
-            # Generate content with JSON mode
-            response = client.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    temperature=0.1
-                )
-            )
-            
-            # Extract text from response
-            text = response.text.strip()
-            
-            if not text:
-                raise ValueError("Empty response from model")
-            
-            # Clean up any markdown code blocks
-            if "```json" in text:
-                text = text.split("```json", 1)[1].split("```", 1)[0].strip()
-            elif "```" in text:
-                text = text.split("```", 1)[1].split("```", 1)[0].strip()
-            
-            # Parse JSON
-            parsed = json.loads(text)
-            
-            if isinstance(parsed, dict) and any(k in parsed for k in ["title", "price", "availability"]):
-                print(f"✅ Successfully used model: {model_name}")
-                return parsed
-            else:
-                raise ValueError("Invalid JSON structure")
-                
-        except Exception as exc:
-            errors[model_name] = str(exc)
-            continue
+    primary, *fallbacks = LLM_MODELS
+
+    try:
+        parsed = _ask_model(client, types, primary, prompt)
+        print(f"✅ Successfully used model: {primary}")
+        return parsed
+    except Exception as exc:
+        errors[primary] = str(exc)
+
+    # Primary failed: race the fallbacks and keep the first valid answer.
+    # Setting `cancel` makes the losing streams stop reading and close.
+    cancel = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=len(fallbacks))
+    try:
+        futures = {pool.submit(_ask_model, client, types, name, prompt, cancel): name for name in fallbacks}
+        for future in as_completed(futures):
+            model_name = futures[future]
+            try:
+                parsed = future.result()
+            except Exception as exc:
+                errors[model_name] = str(exc)
+                continue
+            print(f"✅ Successfully used model: {model_name}")
+            return parsed
+    finally:
+        cancel.set()
+        pool.shutdown(wait=False)
 
     # If all models failed, log errors
-    if errors:
-        formatted = "; ".join(f"{name}: {msg}" for name, msg in errors.items())
-        print(f"[Gemini inference error] All models failed -> {formatted}")
-    
-    return {}
\ No newline at end of file
+    formatted = "; ".join(f"{name}: {msg}" for name, msg in errors.items())
+    print(f"[Gemini inference error] All models failed -> {formatted}")
+    return {}
+
+
+def _ask_model(client, types, model_name: str, prompt: str,
+               cancel: Optional[threading.Event] = None) -> Dict[str, str]:
+    """
+    Stream one model's answer and parse the first JSON object it produces.
+    If `cancel` gets set, stops reading, closes the stream and raises.
+    """
+    if cancel is not None and cancel.is_set():
+        raise RuntimeError("Cancelled")
+    stream = client.models.generate_content_stream(
+        model=model_name,
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            response_mime_type="application/json",
+            temperature=0.1
+        )
+    )
+    parsed = json.loads(_first_json_object(_stream_text(stream, cancel)))
+
+    if isinstance(parsed, dict) and any(k in parsed for k in ["title", "price", "availability"]):
+        return parsed
+    raise ValueError("Invalid JSON structure")
+
+
+def _stream_text(stream, cancel: Optional[threading.Event]) -> Iterable[str]:
+    """Yield chunk text, closing the underlying stream when done or cancelled."""
+    try:
+        for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("Cancelled")
+            yield chunk.text or ""
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+
+def _first_json_object(pieces: Iterable[str]) -> str:
+    """
+    Accumulate streamed text until the first top-level JSON object closes.
+    Stops reading the stream as soon as it does; markdown fences are skipped.
+    """
+    buf = []
+    depth = 0
+    in_string = False
+    escaped = False
+    for piece in pieces:
+        for ch in piece:
+            if not buf and ch != "{":
+                continue
+            buf.append(ch)
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    return "".join(buf)
+    raise ValueError("Incomplete JSON in response" if buf else "Empty response from model")
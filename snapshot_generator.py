@@ -1,20 +1,15 @@
 # snapshot_generator.py
 import os
 import csv
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 SAMPLE_DIR = "snapshots"
+NUM_SAMPLES = 10
 os.makedirs(SAMPLE_DIR, exist_ok=True)
 
-samples = []
 
-# Generate 10 sample HTML files
-for i in range(1, 11):
-    title = f"Example Product {i}"
-    price = f"₹{999 + i * 50}"
-    availability = "In stock" if i % 3 != 0 else "Out of stock"
-
-    html_content = f"""
-    <html>
+TEMPLATE = """<html>
       <head>
         <title>{title} — Buy Now</title>
         <meta property="og:title" content="{title}" />
@@ -24,38 +19,50 @@ for i in range(1, 11):
           <h1 class="product-title">{title}</h1>
           <div id="pricing">
             <span class="price">{price}</span>
-            <div class="availability" id="availability">{availability}</div>
+            <div class="availability" id="availability">{avail}</div>
           </div>
           <ul class="specs">
             <li>Color: Black</li>
-            <li>Weight: {100 + i}g</li>
+            <li>Weight: {weight}g</li>
             <li>SKU: SKU{i:04d}</li>
           </ul>
         </div>
       </body>
-    </html>
-    """
+    </html>"""
+
+
+def render(i: int) -> str:
+    """Build the HTML for sample product `i`."""
+    title = f"Example Product {i}"
+    price = f"₹{999 + i * 50}"
+    availability = "In stock" if i % 3 != 0 else "Out of stock"
+    return TEMPLATE.format(title=title, price=price, avail=availability, weight=100 + i, i=i)
+
 
-    filename = f"product_{i}.html"
-    file_path = os.path.join(SAMPLE_DIR, filename)
+def write_page(page):
+    filename, html_content = page
+    Path(SAMPLE_DIR, filename).write_bytes(html_content.encode("utf-8"))
 
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(html_content.strip())
 
-    samples.append({
-        "filename": filename,
-        "title_selector": "h1.product-title",
-        "price_selector": "span.price",
-        "availability_selector": "#availability"
-    })
+# Generate all sample HTML up front, then write the files in parallel
+samples = [(f"product_{i}.html", render(i)) for i in range(1, NUM_SAMPLES + 1)]
+with ThreadPoolExecutor(8) as ex:
+    list(ex.map(write_page, samples))
 
 # Write CSV mapping file
 csv_path = "sample_mappings.csv"
 with open(csv_path, "w", newline='', encoding="utf-8") as csvfile:
     writer = csv.DictWriter(csvfile, fieldnames=["filename", "title_selector", "price_selector", "availability_selector"])
     writer.writeheader()
-    for row in samples:
-        writer.writerow(row)
+    writer.writerows(
+        {
+            "filename": filename,
+            "title_selector": "h1.product-title",
+            "price_selector": "span.price",
+            "availability_selector": "#availability"
+        }
+        for filename, _ in samples
+    )
 
-print("✅ Generated 10 sample product snapshots in 'snapshots/'")
-print(f"✅ Created CSV mapping file: {csv_path}")
\ No newline at end of file
+print(f"✅ Generated {NUM_SAMPLES} sample product snapshots in '{SAMPLE_DIR}/'")
+print(f"✅ Created CSV mapping file: {csv_path}")